@@ -6,8 +6,11 @@ import json
 import logging
 import os
 import aiohttp
-from collections import defaultdict, deque
+import orjson
+from bisect import bisect_left
+from collections import OrderedDict
 import statistics
+import time
 from datetime import datetime, timedelta
 
 app = FastAPI()
@@ -23,12 +26,93 @@ app.add_middleware(
 
 KAFKA_BOOTSTRAP_SERVERS = "kafka:9092"
 KAFKA_TOPIC = "user_events"
+SLACK_WEBHOOK_URL = os.getenv('SLACK_WEBHOOK_URL')
+SLACK_ENABLED = bool(SLACK_WEBHOOK_URL)
+# Consumers fetch in batches and commit offsets once per batch
+MAX_POLL_RECORDS = 500
+FETCH_MAX_BYTES = 10 * 1024 * 1024
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Store product activity for anomaly detection
-product_activity = defaultdict(lambda: deque(maxlen=100))
+# Store product activity (epoch-second timestamps) for anomaly detection
+MAX_HISTORY = 100
+# Detection windows in seconds: 30s spike, 1m short-term trend,
+# 2m historical baseline, 5m long-term baseline
+WINDOWS = (30, 60, 120, 300)
+
+class ActivityWindow:
+    """Time-ordered timestamps for one product, keeping the newest MAX_HISTORY"""
+    __slots__ = ("timestamps", "last_detect", "cached_at", "cached_alert")
+
+    def __init__(self):
+        self.timestamps = []
+        # When consume_events last ran detection for this product
+        self.last_detect = 0.0
+        # Latest detection result served to the polling endpoints
+        self.cached_at = 0.0
+        self.cached_alert = None
+
+    def __len__(self):
+        return min(len(self.timestamps), MAX_HISTORY)
+
+    def append(self, timestamp: float):
+        timestamps = self.timestamps
+        timestamps.append(timestamp)
+        if len(timestamps) >= 2 * MAX_HISTORY:
+            self._trim()
+
+    def append_many(self, timestamp: float, count: int):
+        """Append the same timestamp count times in one extend"""
+        timestamps = self.timestamps
+        timestamps.extend((timestamp,) * min(count, MAX_HISTORY))
+        if len(timestamps) >= 2 * MAX_HISTORY:
+            self._trim()
+
+    def _trim(self):
+        # Trimming only once the list doubles keeps appends amortized O(1);
+        # rebinding rather than deleting in place means threadpool readers
+        # in counts() never see indices shift under them
+        self.timestamps = self.timestamps[-MAX_HISTORY:]
+
+    def counts(self, now: float) -> tuple:
+        """Number of the newest MAX_HISTORY timestamps within each of WINDOWS, as of now"""
+        # Timestamps are appended in order, so each window count is the
+        # number of samples at or after its cutoff
+        timestamps = self.timestamps
+        size = len(timestamps)
+        lo = size - MAX_HISTORY if size > MAX_HISTORY else 0
+        return tuple(size - bisect_left(timestamps, now - seconds, lo) for seconds in WINDOWS)
+
+class BoundedActivityMap(OrderedDict):
+    """ActivityWindow per product, evicting the least recently active past max_products"""
+
+    def __init__(self, max_products: int):
+        super().__init__()
+        self.max_products = max_products
+
+    def __missing__(self, product_id: str) -> ActivityWindow:
+        if len(self) >= self.max_products:
+            self.popitem(last=False)
+        window = self[product_id] = ActivityWindow()
+        return window
+
+# Cap on tracked products so unique product_ids can't exhaust memory
+MAX_PRODUCTS = 10_000
+product_activity = BoundedActivityMap(MAX_PRODUCTS)
+
+def record_activity(product_id: str, timestamp: float, count: int = 1) -> ActivityWindow:
+    """Append a timestamp (count times) to a product's history, keeping the newest MAX_HISTORY"""
+    history = product_activity[product_id]
+    product_activity.move_to_end(product_id)
+    if count == 1:
+        history.append(timestamp)
+    else:
+        history.append_many(timestamp, count)
+    return history
+
+# Minimum seconds between local anomaly checks for the same product
+DETECT_INTERVAL = 0.5
 
 class ConnectionManager:
     def __init__(self):
@@ -39,25 +123,50 @@ class ConnectionManager:
         self.active_connections.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def broadcast(self, message: str):
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                disconnected.append(connection)
+        # May already have been dropped by a failed broadcast
+        self.active_connections.discard(websocket)
+
+    async def broadcast(self, payload: bytes):
+        # Payload is encoded once by the caller and sent as-is to every client.
+        # Send to a snapshot concurrently so one slow client doesn't hold up the rest
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *[connection.send_bytes(payload) for connection in connections],
+            return_exceptions=True,
+        )
         
-        for connection in disconnected:
-            self.active_connections.remove(connection)
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                self.active_connections.discard(connection)
 
 manager = ConnectionManager()
 
+# Encoded alerts waiting to be broadcast; consumers never wait on clients
+ALERT_QUEUE_SIZE = 1000
+alert_queue: asyncio.Queue = asyncio.Queue(maxsize=ALERT_QUEUE_SIZE)
+
+def enqueue_alert(payload: bytes):
+    """Queue an alert for broadcast, dropping the oldest one if the queue is full"""
+    try:
+        alert_queue.put_nowait(payload)
+    except asyncio.QueueFull:
+        alert_queue.get_nowait()
+        alert_queue.put_nowait(payload)
+
+async def broadcast_alerts():
+    """Drain the alert queue and fan each payload out to WebSocket clients"""
+    while True:
+        payload = await alert_queue.get()
+        await manager.broadcast(payload)
+
+# Shared HTTP session for Slack webhooks, reusing keep-alive connections
+SLACK_SESSION: aiohttp.ClientSession | None = None
+# Strong references to in-flight Slack sends so they aren't garbage collected
+slack_tasks = set()
+
 async def send_slack_alert(alert: dict):
     """Send alert to Slack webhook if SLACK_WEBHOOK_URL is set."""
-    webhook = os.getenv('SLACK_WEBHOOK_URL')
-    if not webhook:
+    if not SLACK_ENABLED or SLACK_SESSION is None:
         return
     payload = {
         "text": f"🚨 Herd behavior detected for *{alert.get('product_id')}*\nViews: {alert.get('current_count')} | z: {alert.get('z_score')}",
@@ -69,83 +178,94 @@ async def send_slack_alert(alert: dict):
         ]
     }
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(webhook, json=payload, timeout=10) as resp:
-                if resp.status >= 400:
-                    logger.warning(f"Slack webhook failed with status {resp.status}")
+        async with SLACK_SESSION.post(SLACK_WEBHOOK_URL, json=payload) as resp:
+            if resp.status >= 400:
+                logger.warning(f"Slack webhook failed with status {resp.status}")
     except Exception as e:
         logger.exception(f"Failed to send Slack alert: {e}")
 
-def detect_anomaly(product_id: str) -> dict:
+def schedule_slack_alert(alert: dict):
+    """Send a Slack alert in the background without blocking the caller"""
+    task = asyncio.create_task(send_slack_alert(alert))
+    slack_tasks.add(task)
+    task.add_done_callback(slack_tasks.discard)
+
+def detect_anomaly(product_id: str, now: float = None,
+                   _time=time.time, _fromtimestamp=datetime.utcfromtimestamp) -> dict:
     """Enhanced herd behavior detection with multiple metrics"""
-    history = list(product_activity[product_id])
+    history = product_activity.get(product_id)
     
-    if len(history) < 20:  # Increased minimum data
+    if history is None or len(history) < 20:  # Increased minimum data
         return None
     
-    current_time = datetime.utcnow()
+    if now is None:
+        now = _time()
     
-    # Multiple time windows for better analysis
-    windows = {
-        'recent_30s': 30,      # Spike detection
-        'recent_1m': 60,       # Short-term trend
-        'baseline_2m': 120,    # Historical baseline
-        'baseline_5m': 300     # Long-term baseline
-    }
+    c30, c60, c120, c300 = history.counts(now)
     
-    counts = {}
-    for window_name, seconds in windows.items():
-        counts[window_name] = len([
-            event_time for event_time in history 
-            if (current_time - event_time).total_seconds() <= seconds
-        ])
+    # Multiple detection criteria: 30s recent count against 2m baseline
+    if c120 < 3 or c30 < 10:
+        return None
     
-    recent_count = counts['recent_30s']
-    baseline_count = counts['baseline_2m']
+    ratio = c30 / c120
+    # Enhanced z-score
+    z_score = (c30 - c120) / c120 ** 0.5
+    # Velocity (events per minute), 5m normalized to per-minute
+    velocity_5m = c300 / 5
     
-    # Multiple detection criteria
-    if baseline_count >= 3 and recent_count >= 10:
-        ratio = recent_count / baseline_count if baseline_count > 0 else float('inf')
-        
-        # Calculate enhanced z-score
-        z_score = (recent_count - baseline_count) / (max(1, baseline_count) ** 0.5)
-        
-        # Velocity (events per minute)
-        velocity_1m = counts['recent_1m']
-        velocity_5m = counts['baseline_5m'] / 5  # Normalize to per-minute
-        
-        # Multiple trigger conditions
-        ratio_trigger = ratio >= 2.5  # Lowered from 3.0 for sensitivity
-        velocity_trigger = velocity_1m >= (velocity_5m * 3)  # 3x velocity increase
-        absolute_trigger = recent_count >= 15  # Absolute threshold
-        
-        if ratio_trigger or velocity_trigger or absolute_trigger:
-            confidence = min(100, max(0, z_score * 15 + 50))  # 0-100% confidence
-            
-            return {
-                "product_id": product_id,
-                "current_count": recent_count,
-                "z_score": round(z_score, 2),
-                "mean": round(baseline_count, 1),
-                "ratio": round(ratio, 2),
-                "velocity_1m": velocity_1m,
-                "velocity_5m": round(velocity_5m, 1),
-                "confidence": round(confidence, 1),
-                "detected_at": current_time.isoformat(),
-                "trigger_type": (
-                    "ratio" if ratio_trigger else 
-                    "velocity" if velocity_trigger else 
-                    "absolute"
-                )
-            }
+    # Multiple trigger conditions, reported in priority order
+    if ratio >= 2.5:  # Lowered from 3.0 for sensitivity
+        trigger_type = "ratio"
+    elif c60 >= velocity_5m * 3:  # 3x velocity increase
+        trigger_type = "velocity"
+    elif c30 >= 15:  # Absolute threshold
+        trigger_type = "absolute"
+    else:
+        return None
     
-    return None
+    return {
+        "product_id": product_id,
+        "current_count": c30,
+        "z_score": round(z_score, 2),
+        "mean": round(c120, 1),
+        "ratio": round(ratio, 2),
+        "velocity_1m": c60,
+        "velocity_5m": round(velocity_5m, 1),
+        # 0-100% confidence
+        "confidence": round(min(100, max(0, z_score * 15 + 50)), 1),
+        "detected_at": _fromtimestamp(now).isoformat(),
+        "trigger_type": trigger_type,
+    }
+
+# How long the polling endpoints reuse a product's detection result
+ALERT_CACHE_TTL = 1.0
+
+def cached_detect(product_id: str, now: float) -> dict:
+    """detect_anomaly, reusing a result computed within the last ALERT_CACHE_TTL seconds"""
+    history = product_activity.get(product_id)
+    if history is None:
+        return None
+    if now - history.cached_at < ALERT_CACHE_TTL:
+        return history.cached_alert
+    alert = detect_anomaly(product_id, now)
+    history.cached_at = now
+    history.cached_alert = alert
+    return alert
+
 @app.on_event("startup")
 async def startup_event():
+    global SLACK_SESSION
+    SLACK_SESSION = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    asyncio.create_task(broadcast_alerts())
     # Start both consumers: raw user events and pre-computed alerts
     asyncio.create_task(consume_events())
     asyncio.create_task(consume_alerts())
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if SLACK_SESSION is not None:
+        await SLACK_SESSION.close()
+
 async def consume_events():
     """Consume raw user_events from Kafka and update in-memory activity window."""
     consumer = AIOKafkaConsumer(
@@ -153,6 +273,9 @@ async def consume_events():
         bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
         group_id="herd_backend_events",
         auto_offset_reset="earliest",
+        enable_auto_commit=False,
+        max_poll_records=MAX_POLL_RECORDS,
+        fetch_max_bytes=FETCH_MAX_BYTES,
     )
 
     # Retry connection
@@ -170,32 +293,55 @@ async def consume_events():
                 logger.error("💥 Failed to connect to Kafka after all retries")
                 return
 
+    # Products with activity not yet checked for anomalies, mapped to their
+    # activity windows; kept across polls until their throttle interval passes
+    pending = {}
     try:
-        async for msg in consumer:
-            try:
-                event = json.loads(msg.value.decode("utf-8"))
-            except Exception:
-                logger.debug('Received non-json event, skipping')
-                continue
-
-            logger.info(f"📩 Received Event: {event.get('event_type')} for product {event.get('product_id')}")
-            
-            # Track product activity for anomaly detection
-            product_id = event.get('product_id')
-            if not product_id:
-                continue
-            product_activity[product_id].append(datetime.utcnow())
-            
-            # Check for herd behavior locally as a fallback
-            alert = detect_anomaly(product_id)
-            
-            if alert:
-                logger.info(f"🚨 HERD BEHAVIOR DETECTED (local): {product_id} (count: {alert['current_count']}, z-score: {alert['z_score']})")
-                # Send alert to all connected WebSocket clients
-                await manager.broadcast(json.dumps(alert))
+        while True:
+            batch = await consumer.getmany(timeout_ms=100, max_records=MAX_POLL_RECORDS)
+            # One clock read per poll batch, shared by every event in it
+            now = time.time()
+            alerts = []
+            for tp, msgs in batch.items():
+                for msg in msgs:
+                    try:
+                        event = orjson.loads(msg.value)
+                    except Exception:
+                        logger.debug('Received non-json event, skipping')
+                        continue
+
+                    logger.info(f"📩 Received Event: {event.get('event_type')} for product {event.get('product_id')}")
+                    
+                    # Track product activity for anomaly detection
+                    product_id = event.get('product_id')
+                    if not product_id:
+                        continue
+                    pending[product_id] = record_activity(product_id, now)
+
+            # Check for herd behavior locally as a fallback, once the whole
+            # batch is recorded and at most once per DETECT_INTERVAL per product.
+            # Throttled products stay pending and are rechecked on later polls,
+            # including empty ones, so the tail of a burst is still evaluated.
+            for product_id, history in list(pending.items()):
+                if now - history.last_detect < DETECT_INTERVAL:
+                    continue
+                del pending[product_id]
+                history.last_detect = now
+                alert = detect_anomaly(product_id, now)
+                
+                if alert:
+                    logger.info(f"🚨 HERD BEHAVIOR DETECTED (local): {product_id} (count: {alert['current_count']}, z-score: {alert['z_score']})")
+                    alerts.append(alert)
+
+            if batch:
+                await consumer.commit()
+
+            for alert in alerts:
+                # Queue alert for all connected WebSocket clients
+                enqueue_alert(orjson.dumps(alert))
                 # send Slack if configured
-                if os.getenv('SLACK_WEBHOOK_URL'):
-                    await send_slack_alert(alert)
+                if SLACK_ENABLED:
+                    schedule_slack_alert(alert)
 
     except Exception as e:
         logger.error(f"⚠️ Kafka consumer error: {e}")
@@ -210,6 +356,9 @@ async def consume_alerts():
         bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
         group_id="herd_backend_alerts",
         auto_offset_reset="earliest",
+        enable_auto_commit=False,
+        max_poll_records=MAX_POLL_RECORDS,
+        fetch_max_bytes=FETCH_MAX_BYTES,
     )
 
     # Retry connection
@@ -228,19 +377,30 @@ async def consume_alerts():
                 return
 
     try:
-        async for msg in consumer:
-            try:
-                alert = json.loads(msg.value.decode("utf-8"))
-            except Exception:
-                logger.debug('Received non-json alert, skipping')
+        while True:
+            batch = await consumer.getmany(timeout_ms=100, max_records=MAX_POLL_RECORDS)
+            if not batch:
                 continue
-
-            logger.info(f"🚨 Alert received from stream processor for product: {alert.get('product_id')}")
-            # Broadcast alert payload directly to connected clients
-            await manager.broadcast(json.dumps(alert))
-            # send Slack if configured
-            if os.getenv('SLACK_WEBHOOK_URL'):
-                await send_slack_alert(alert)
+            alerts = []
+            for tp, msgs in batch.items():
+                for msg in msgs:
+                    try:
+                        alert = orjson.loads(msg.value)
+                    except Exception:
+                        logger.debug('Received non-json alert, skipping')
+                        continue
+
+                    logger.info(f"🚨 Alert received from stream processor for product: {alert.get('product_id')}")
+                    alerts.append(alert)
+
+            await consumer.commit()
+
+            for alert in alerts:
+                # Queue alert payload for connected clients
+                enqueue_alert(orjson.dumps(alert))
+                # send Slack if configured
+                if SLACK_ENABLED:
+                    schedule_slack_alert(alert)
 
     except Exception as e:
         logger.error(f"⚠️ Alerts consumer error: {e}")
@@ -274,8 +434,9 @@ def health_check():
 def get_alerts():
     # Return current detected alerts
     alerts = []
+    now = time.time()
     for product_id in list(product_activity.keys()):
-        alert = detect_anomaly(product_id)
+        alert = cached_detect(product_id, now)
         if alert:
             alerts.append({
                 "product": product_id,
@@ -299,13 +460,13 @@ async def track_event(event: dict):
     try:
         product_id = event.get("product_id")
         if product_id:
-            product_activity[product_id].append(datetime.utcnow())
+            record_activity(product_id, time.time())
             
             # Check for herd behavior
             alert = detect_anomaly(product_id)
             if alert:
                 logger.info(f"🚨 HERD BEHAVIOR DETECTED via HTTP: {product_id}")
-                await manager.broadcast(json.dumps(alert))
+                enqueue_alert(orjson.dumps(alert))
         
         return {"status": "accepted"}
     except Exception as e:
@@ -317,8 +478,9 @@ async def track_event(event: dict):
 def get_trending_alerts():
     """Get only trending alerts (z-score > 3)"""
     trending_alerts = []
+    now = time.time()
     for product_id in list(product_activity.keys()):
-        alert = detect_anomaly(product_id)
+        alert = cached_detect(product_id, now)
         if alert and alert.get("z_score", 0) > 3:
             trending_alerts.append({
                 "product": product_id,
@@ -355,19 +517,19 @@ def get_alert_history():
 @app.post("/simulate/spike/{product_id}")
 async def simulate_spike(product_id: str):
     """Simulate herd behavior for testing"""
-    current_time = datetime.utcnow()
+    current_time = time.time()
     
     # Add multiple events in quick succession to trigger alert
-    for i in range(15):
-        product_activity[product_id].append(current_time)
+    record_activity(product_id, current_time, 15)
     
     alert = detect_anomaly(product_id)
     if alert:
-        await manager.broadcast(json.dumps(alert))
+        enqueue_alert(orjson.dumps(alert))
         return {"status": "spike_created", "alert": alert}
     else:
         return {"status": "no_alert_triggered"}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # loop="auto" runs on uvloop where it is installed (not on Windows)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto")
\ No newline at end of file
@@ -75,6 +75,9 @@ export default function TrendingList() {
   useEffect(() => {
     console.log('🔌 Connecting to WebSocket...');
     const ws = new WebSocket('ws://localhost:8000/ws');
+    // Alerts arrive as pre-encoded UTF-8 JSON in binary frames
+    ws.binaryType = 'arraybuffer';
+    const decoder = new TextDecoder('utf-8');
     
     ws.onopen = () => {
       console.log('✅ WebSocket connected successfully');
@@ -82,11 +85,12 @@ export default function TrendingList() {
     };
 
     ws.onmessage = (evt) => {
-      console.log('📨 WebSocket message received:', evt.data);
-      setLastMessage(evt.data);
+      const text = typeof evt.data === 'string' ? evt.data : decoder.decode(evt.data);
+      console.log('📨 WebSocket message received:', text);
+      setLastMessage(text);
       
       try {
-        const data = JSON.parse(evt.data);
+        const data = JSON.parse(text);
         console.log('📊 Parsed WebSocket data:', data);
         
         // Handle different message formats
@@ -1,7 +1,8 @@
+import asyncio
 import faust
 import json
 import math
-from statistics import mean, pstdev
+from collections import deque
 
 APP_NAME = 'herd-detector'
 KAFKA_BROKER = 'kafka://localhost:9092'  # when running in Docker network, use kafka:9092
@@ -21,8 +22,54 @@ epsilon = 1e-6
 
 # counts per product per short window
 short_counts = app.Table('short_counts', default=int).tumbling(SHORT_WINDOW, expires=BASELINE_WINDOW*2)
-# baseline sample store as a simple list of past short-window counts
-baseline_store = app.Table('baseline_store', default=list)
+# baseline sample store as a bounded deque of past short-window counts
+# (oldest sample evicted automatically past BASELINE_SAMPLES)
+BASELINE_SAMPLES = 60
+baseline_store = app.Table('baseline_store', default=lambda: deque(maxlen=BASELINE_SAMPLES))
+# running (count, mean, M2) over the baseline samples, excluding the newest one
+baseline_stats = app.Table('baseline_stats', default=lambda: (0, 0.0, 0.0))
+
+
+def welford_add(stats, x):
+    """Add sample x to running (count, mean, M2) stats (Welford)."""
+    n, m, m2 = stats
+    n += 1
+    delta = x - m
+    m += delta / n
+    m2 += delta * (x - m)
+    return n, m, m2
+
+
+def welford_remove(stats, x):
+    """Remove sample x from running (count, mean, M2) stats."""
+    n, m, m2 = stats
+    if n <= 1:
+        return 0, 0.0, 0.0
+    n -= 1
+    delta = x - m
+    m -= delta / n
+    m2 -= delta * (x - m)
+    return n, m, max(0.0, m2)
+
+
+def compute_alerts(snapshot, detected_at):
+    """Return alerts for (pid, current count, baseline stats) snapshot tuples."""
+    alerts = []
+    for pid, curr, (n, m, m2) in snapshot:
+        if n < 5 or curr < min_count:
+            continue
+        s = math.sqrt(m2 / n)
+        z = (curr - m) / (s + epsilon)
+        if (s < 1 and curr >= m * 3) or (z > z_threshold):
+            alerts.append({
+                "product_id": pid,
+                "current_count": curr,
+                "baseline_mean": m,
+                "baseline_std": s,
+                "z_score": z,
+                "detected_at": detected_at
+            })
+    return alerts
 
 @app.agent(events)
 async def process(stream):
@@ -43,35 +90,36 @@ async def process(stream):
 async def detect():
     # copy keys
     keys = list(short_counts.keys())
+    snapshot = []
     for pid in keys:
         curr = short_counts[pid].now()  # current window count
-        # append to baseline store (limit size)
+        # append to baseline store; the deque drops the oldest sample past
+        # BASELINE_SAMPLES (30min / 1min = 30 samples, plus some breathing room)
         bl = baseline_store[pid]
+        if not isinstance(bl, deque):  # recovered from the changelog as a list
+            bl = deque(bl, maxlen=BASELINE_SAMPLES)
+
+        # baseline stats ignore the current sample; rebuild them if they are
+        # out of step with the stored samples (e.g. after a partial recovery)
+        stats = baseline_stats[pid]
+        if stats[0] != max(0, len(bl) - 1):
+            stats = (0, 0.0, 0.0)
+            for x in list(bl)[:-1]:
+                stats = welford_add(stats, x)
+        if bl:
+            # previous sample joins the baseline, oldest leaves once full
+            stats = welford_add(stats, bl[-1])
+            if len(bl) == BASELINE_SAMPLES:
+                stats = welford_remove(stats, bl[0])
         bl.append(curr)
-        # keep at most baseline window length (30min / 1min = 30 samples)
-        if len(bl) > 60:  # some breathing room
-            bl.pop(0)
         baseline_store[pid] = bl
+        baseline_stats[pid] = stats
+        snapshot.append((pid, curr, stats))
 
-        # compute baseline stats ignoring current sample if insufficient history
-        hist = [x for x in bl[:-1]] if len(bl) > 1 else []
-        if len(hist) < 5:
-            continue
-
-        m = mean(hist)
-        s = pstdev(hist) if len(hist) > 1 else 0.0
-
-        if curr >= min_count:
-            z = (curr - m) / (s + epsilon)
-            if (s < 1 and curr >= m * 3) or (z > z_threshold):
-                alert = {
-                    "product_id": pid,
-                    "current_count": curr,
-                    "baseline_mean": m,
-                    "baseline_std": s,
-                    "z_score": z,
-                    "detected_at": app.now().isoformat()
-                }
-                await alerts_topic.send(value=json.dumps(alert).encode())
-                # optionally clear recent counts to avoid alert storm for same spike
-                short_counts[pid] = 0
+    # table updates stay on the loop; the stats pass runs in a worker thread
+    alerts = await asyncio.to_thread(compute_alerts, snapshot, app.now().isoformat())
+    for alert in alerts:
+        await alerts_topic.send(value=json.dumps(alert).encode())
+        # optionally clear recent counts to avoid alert storm for same spike;
+        # subtract the snapshotted count so events that arrived meanwhile are kept
+        short_counts[alert["product_id"]] -= alert["current_count"]